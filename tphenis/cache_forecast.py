@@ -10,11 +10,46 @@ import logging
 
 import util.wxenums as wxenums
 import util.fcast_cache as fcast_cache
+import util.fcast_proto as fcast_proto
 
 LOGGER = logging.getLogger('tphenis')
 logging.basicConfig(format='%(asctime)s %(levelname)-8s - %(module)s.%(funcName)s() - %(message)s ',
                     datefmt= '%Y%m%d %H:%M:%S')
 
+# ---------------------------------------------------------------------------------------------------------------------
+# METHODS
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def reload_server_callback(source, location):
+    # Let a running fcast_server.py pick up the cache change; it's fine if no server is running
+    try:
+        fcast_proto.query(fcast_proto.OP_RELOAD, source.name, location.name)
+    except OSError:
+        LOGGER.debug("No forecast server to notify at {}".format(fcast_proto.get_socket_path()))
+
+
+def fanout_callback(source, location, fcast_str, fcast_hash):
+    # Imported here so hosts without imapclient or util/email_creds.py still cache forecasts
+    try:
+        import util.email_io as email_io
+        import wxsrc
+    except ImportError as e:
+        LOGGER.warning("Email fan-out unavailable, skipping: {}".format(e))
+        return
+
+    sub_registry = email_io.SubscriptionRegistry()
+    sub_registry.load()
+    delivery_log = email_io.DeliveryLog()
+    delivery_log.load()
+
+    # Subscribers get the forecast text from the page; the page itself is only sent if that can't be found
+    body = wxsrc.get_forecast_text(fcast_str)
+    if body is not None:
+        email_io.fanout_forecast(source, location, body, fcast_hash, sub_registry, delivery_log)
+    else:
+        email_io.fanout_forecast(source, location, fcast_str, fcast_hash, sub_registry, delivery_log, subtype="html")
+
 # ---------------------------------------------------------------------------------------------------------------------
 # main()
 # ---------------------------------------------------------------------------------------------------------------------
@@ -30,6 +65,15 @@ def main():
                             help="Set the logging level",
                             dest='loglevel')
 
+    fanout_group = arg_parser.add_mutually_exclusive_group()
+    fanout_group.add_argument('--no-fanout', action='store_false', required=False, default=True,
+                              help="Don't push a new forecast revision to email subscribers",
+                              dest='fanout')
+    fanout_group.add_argument('--retry-fanout', action='store_true', required=False, default=False,
+                              help="Don't fetch; push the latest cached revision to subscribers who haven't "
+                                   "received it",
+                              dest='retry_fanout')
+
     args = arg_parser.parse_args()
 
     numeric_level = getattr(logging, args.loglevel.upper())
@@ -51,6 +95,24 @@ def main():
         LOGGER.critical("Invalid forecast location specified: {}".format(args.loc))
         exit(1)
 
+    if args.retry_fanout:
+        revisions = fcast_cache.get_cached_revisions(source, location)
+        if len(revisions) == 0:
+            LOGGER.critical("No cached forecast to push for {} {}".format(source.name, location.name))
+            exit(1)
+
+        revision, mtime, path = revisions[-1]
+        with open(path, 'r') as f:
+            fcast_str = f.read()
+        LOGGER.info("Retrying fan-out of cached revision: {}".format(revision))
+        fanout_callback(source, location, fcast_str, fcast_cache.hash_forecast(fcast_str))
+        return
+
+    fcast_cache.register_cache_update_callback(reload_server_callback)
+
+    if args.fanout:
+        fcast_cache.register_new_forecast_callback(fanout_callback)
+
     # todo Create an option to force an overwrite?
     fcast_cache.get_raw_forecast(source, location, use_cache=False, save_forecast=True)
 
@@ -33,6 +33,9 @@ POLL_INTERVAL = 10
 registry = email_io.EmailRegistry()
 registry.load()
 
+sub_registry = email_io.SubscriptionRegistry()
+sub_registry.load()
+
 smtp_client, imap_client = None, None
 
 # Get the client for outgoing mail
@@ -47,7 +50,7 @@ try:
     msgs = email_io.get_inbox_messages(imap_client)
     LOGGER.info("Found {} unprocessed messages on startup.".format(len(msgs)))
     forecast_requests = email_io.process_inbox_messages(msgs, imap_client, registry)
-    email_io.process_forecast_requests(forecast_requests, smtp_client, imap_client, registry)
+    email_io.process_forecast_requests(forecast_requests, smtp_client, imap_client, registry, sub_registry)
 
     LOGGER.info("Polling for new messages every {} seconds.".format(POLL_INTERVAL))
     # This was implemented to avoid putting the server into IDLE mode, but that decision was arbitrary.  Consider
@@ -70,7 +73,7 @@ try:
             if len(msgs) > 0:
                 forecast_requests = email_io.process_inbox_messages(msgs, imap_client, registry)
                 LOGGER.info("Processing {} new messages.".format(len(forecast_requests)))
-                email_io.process_forecast_requests(forecast_requests, smtp_client, imap_client, registry)
+                email_io.process_forecast_requests(forecast_requests, smtp_client, imap_client, registry, sub_registry)
         except KeyboardInterrupt:
             break
 
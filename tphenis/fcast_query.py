@@ -0,0 +1,87 @@
+# Copyright 2021 Patrick Mauro and Harrison Hamlin
+# Contents are proprietary and confidential.
+
+# Thin client for fcast_server.py.  Only the standard library and util.fcast_proto may be imported here -- pulling in
+# fcast_cache, wxsrc, etc. would bring bs4/requests/pytz along and defeat the point of asking the server.
+
+# ---------------------------------------------------------------------------------------------------------------------
+# IMPORTS
+# ---------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import sys
+
+import util.fcast_proto as fcast_proto
+
+# ---------------------------------------------------------------------------------------------------------------------
+# GLOBALS
+# ---------------------------------------------------------------------------------------------------------------------
+
+COMMANDS = {
+    'latest': fcast_proto.OP_LATEST,
+    'get': fcast_proto.OP_GET,
+    'as-of': fcast_proto.OP_AS_OF,
+    'reload': fcast_proto.OP_RELOAD,
+    'ping': fcast_proto.OP_PING
+}
+
+# Exit codes 0-3 are the server's response status; this one means there was no response at all
+EXIT_UNREACHABLE = 4
+
+# ---------------------------------------------------------------------------------------------------------------------
+# main()
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Query the resident forecast server.")
+
+    arg_parser.add_argument('command', choices=list(COMMANDS.keys()), help='query to run')
+    arg_parser.add_argument('--src', action='store', required=False, default='MORA_REC_FCST', help='forecast source')
+    arg_parser.add_argument('--loc', action='store', required=False, default='MORA', help='forecast location')
+    arg_parser.add_argument('--rev', action='store', required=False,
+                            help="revision to fetch with 'get', e.g. 20211103.2")
+    arg_parser.add_argument('--time', action='store', required=False,
+                            help="fetch the forecast current at this time with 'as-of', "
+                                 "e.g. '20211103 14:00:00' (US/Pacific)")
+    arg_parser.add_argument('--parsed', action='store_true', required=False, default=False,
+                            help='return the parsed forecast rather than the raw text')
+    arg_parser.add_argument('--socket', action='store', required=False, default=None,
+                            help='path of the server socket')
+
+    args = arg_parser.parse_args()
+
+    op = COMMANDS[args.command]
+    field = fcast_proto.FIELD_PARSED if args.parsed else fcast_proto.FIELD_RAW
+
+    if op == fcast_proto.OP_PING:
+        query_args = ()
+    elif op == fcast_proto.OP_RELOAD:
+        query_args = (args.src, args.loc)
+    elif op == fcast_proto.OP_GET:
+        if args.rev is None:
+            arg_parser.error("'get' requires --rev")
+        query_args = (args.src, args.loc, field, args.rev)
+    elif op == fcast_proto.OP_AS_OF:
+        if args.time is None:
+            arg_parser.error("'as-of' requires --time")
+        query_args = (args.src, args.loc, field, args.time)
+    else:
+        query_args = (args.src, args.loc, field)
+
+    try:
+        status, payload = fcast_proto.query(op, *query_args, socket_path=args.socket)
+    except OSError as e:
+        sys.stderr.write("Could not reach forecast server: {}\n".format(e))
+        exit(EXIT_UNREACHABLE)
+
+    if status == fcast_proto.STATUS_OK:
+        sys.stdout.write(payload.decode())
+        exit(0)
+
+    sys.stderr.write(payload.decode() + "\n")
+    exit(status)
+
+
+if __name__ == "__main__":
+    main()
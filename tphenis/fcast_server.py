@@ -0,0 +1,263 @@
+# Copyright 2021 Patrick Mauro and Harrison Hamlin
+# Contents are proprietary and confidential.
+
+# ---------------------------------------------------------------------------------------------------------------------
+# IMPORTS
+# ---------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import bisect
+from datetime import datetime
+import logging
+import os
+import socketserver
+import stat
+import threading
+
+from pytz import timezone
+
+import util.wxenums as wxenums
+import util.fcast_cache as fcast_cache
+import util.fcast_proto as fcast_proto
+import wxsrc
+
+LOGGER = logging.getLogger('tphenis')
+logging.basicConfig(format='%(asctime)s %(levelname)-8s - %(module)s.%(funcName)s() - %(message)s ',
+                    datefmt= '%Y%m%d %H:%M:%S')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# CLASSES
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+class ForecastStore:
+    # Keeps the latest raw and parsed forecast per (source, location) in memory, along with an index of every cached
+    # revision; older revisions are read from disk on request.  Readers only ever see fully-built entries: _load()
+    # builds the new entry off to the side and swaps it in under the lock.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._load_locks = dict()
+
+    def _get_load_lock(self, source, location):
+        with self._lock:
+            return self._load_locks.setdefault((source, location), threading.Lock())
+
+    def load(self, source, location):
+        # Loads of the same (source, location) are serialized from listing to swap, so a slower, older listing can't
+        # overwrite a newer one
+        with self._get_load_lock(source, location):
+            self._load(source, location)
+
+    def _load(self, source, location):
+        with self._lock:
+            previous = self._entries.get((source, location))
+
+        # Listing the cache only stats files; the forecast itself is re-read and re-parsed only if the latest changed
+        revisions = fcast_cache.get_cached_revisions(source, location)
+        revision_index = {revision: i for i, (revision, mtime, path) in enumerate(revisions)}
+        # as-of searches by time, which needn't follow revision order (e.g. after restoring the cache from a backup)
+        time_order = sorted(range(len(revisions)), key=lambda i: revisions[i][1])
+        mtimes = [revisions[i][1] for i in time_order]
+        aliases = fcast_cache.get_cached_aliases(source, location)
+
+        latest_raw, latest_parsed = None, None
+        if len(revisions) > 0:
+            if previous is not None and len(previous["revisions"]) > 0 and \
+                    previous["revisions"][-1] == revisions[-1]:
+                latest_raw, latest_parsed = previous["latest_raw"], previous["latest_parsed"]
+            else:
+                with open(revisions[-1][2], 'r') as f:
+                    latest_raw = f.read()
+                latest_parsed = wxsrc.render_forecast(source, latest_raw)
+
+        with self._lock:
+            self._entries[(source, location)] = {
+                "revisions": revisions,
+                "mtimes": mtimes,
+                "time_order": time_order,
+                "revision_index": revision_index,
+                "aliases": aliases,
+                "latest_raw": latest_raw,
+                "latest_parsed": latest_parsed
+            }
+
+        LOGGER.info("Loaded {} revisions for {} {}".format(len(revisions), source.name, location.name))
+
+    def load_all(self):
+        for source in wxenums.ForecastSource:
+            for location in wxenums.Location:
+                self.load(source, location)
+
+    def _render(self, source, entry, index, field):
+        if index == len(entry["revisions"]) - 1:
+            return entry["latest_raw"] if field == fcast_proto.FIELD_RAW else entry["latest_parsed"]
+
+        with open(entry["revisions"][index][2], 'r') as f:
+            raw = f.read()
+        return raw if field == fcast_proto.FIELD_RAW else wxsrc.render_forecast(source, raw)
+
+    def latest(self, source, location, field):
+        with self._lock:
+            entry = self._entries.get((source, location))
+        if entry is None or len(entry["revisions"]) == 0:
+            return None
+        return self._render(source, entry, len(entry["revisions"]) - 1, field)
+
+    def get(self, source, location, field, revision):
+        with self._lock:
+            entry = self._entries.get((source, location))
+        if entry is None:
+            return None
+        revision = entry["aliases"].get(revision, revision)
+        if revision not in entry["revision_index"]:
+            return None
+        return self._render(source, entry, entry["revision_index"][revision], field)
+
+    def as_of(self, source, location, field, timestamp):
+        with self._lock:
+            entry = self._entries.get((source, location))
+        if entry is None:
+            return None
+        position = bisect.bisect_right(entry["mtimes"], timestamp) - 1
+        if position < 0:
+            return None
+        return self._render(source, entry, entry["time_order"][position], field)
+
+
+class ForecastRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Clients may send any number of requests over one connection
+        while True:
+            try:
+                frame = fcast_proto.recv_frame(self.request)
+            except (OSError, ValueError) as e:
+                LOGGER.warning("Dropping connection: {}".format(e))
+                return
+            if frame is None:
+                return
+
+            # Anything that goes wrong serving the request is reported to the client rather than killing the handler
+            try:
+                status, text = self.dispatch(*frame)
+            except Exception as e:
+                LOGGER.exception("Error handling request: {}".format(frame[0]))
+                status, text = fcast_proto.STATUS_ERROR, "Server error: {}".format(e)
+
+            try:
+                fcast_proto.send_frame(self.request, status, text.encode())
+            except OSError as e:
+                LOGGER.warning("Dropping connection: {}".format(e))
+                return
+
+    def dispatch(self, op, payload):
+        store = self.server.store
+        try:
+            args = fcast_proto.decode_args(payload)
+        except UnicodeDecodeError:
+            return fcast_proto.STATUS_BAD_REQUEST, "Request arguments must be UTF-8"
+
+        if op == fcast_proto.OP_PING:
+            return fcast_proto.STATUS_OK, "pong"
+
+        if len(args) < 2:
+            return fcast_proto.STATUS_BAD_REQUEST, "Expected a source and a location"
+        try:
+            source = wxenums.ForecastSource[args[0]]
+            location = wxenums.Location[args[1]]
+        except KeyError:
+            return fcast_proto.STATUS_BAD_REQUEST, "Invalid source or location: {} {}".format(args[0], args[1])
+
+        if op == fcast_proto.OP_RELOAD:
+            store.load(source, location)
+            return fcast_proto.STATUS_OK, ""
+
+        if len(args) < 3 or args[2] not in (fcast_proto.FIELD_RAW, fcast_proto.FIELD_PARSED):
+            return fcast_proto.STATUS_BAD_REQUEST, "Expected a field of '{}' or '{}'".format(
+                fcast_proto.FIELD_RAW, fcast_proto.FIELD_PARSED)
+        field = args[2]
+
+        if op == fcast_proto.OP_LATEST:
+            result = store.latest(source, location, field)
+        elif op == fcast_proto.OP_GET and len(args) == 4:
+            result = store.get(source, location, field, args[3])
+        elif op == fcast_proto.OP_AS_OF and len(args) == 4:
+            try:
+                local_time = datetime.strptime(args[3], fcast_proto.AS_OF_FORMAT)
+                timestamp = timezone(fcast_cache.STANDARD_TIMEZONE).localize(local_time).timestamp()
+            except ValueError:
+                return fcast_proto.STATUS_BAD_REQUEST, "Could not parse time: {}".format(args[3])
+            result = store.as_of(source, location, field, timestamp)
+        else:
+            return fcast_proto.STATUS_BAD_REQUEST, "Unknown operation or wrong arguments: {}".format(op)
+
+        if result is None:
+            return fcast_proto.STATUS_NOT_FOUND, "No forecast found"
+        return fcast_proto.STATUS_OK, result
+
+
+class ForecastServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, store):
+        self.store = store
+        super().__init__(socket_path, ForecastRequestHandler)
+
+# ---------------------------------------------------------------------------------------------------------------------
+# main()
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serve cached forecasts from memory over a Unix socket.")
+
+    arg_parser.add_argument('--socket', action='store', required=False, default=fcast_proto.get_socket_path(),
+                            help='path of the Unix socket to listen on')
+    arg_parser.add_argument('--log-level', action='store', required=False, default='INFO',
+                            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                            help="Set the logging level",
+                            dest='loglevel')
+
+    args = arg_parser.parse_args()
+
+    numeric_level = getattr(logging, args.loglevel.upper())
+    LOGGER.setLevel(numeric_level)
+
+    # A leftover socket file from an unclean shutdown would make bind() fail.  Only remove it when it's a socket that
+    # refuses connections; a server that answers (or is too busy to answer) and anything that isn't a socket are left
+    # alone.
+    if os.path.exists(args.socket):
+        if not stat.S_ISSOCK(os.stat(args.socket).st_mode):
+            LOGGER.critical("Socket path exists and is not a socket: {}".format(args.socket))
+            exit(1)
+
+        try:
+            fcast_proto.query(fcast_proto.OP_PING, socket_path=args.socket)
+        except ConnectionRefusedError:
+            LOGGER.info("Removing stale socket: {}".format(args.socket))
+            os.unlink(args.socket)
+        except OSError as e:
+            LOGGER.critical("Could not tell whether a server owns {}: {}".format(args.socket, e))
+            exit(1)
+        else:
+            LOGGER.critical("A forecast server is already listening on {}".format(args.socket))
+            exit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+
+    store = ForecastStore()
+    store.load_all()
+
+    server = ForecastServer(args.socket, store)
+    LOGGER.info("Listening on {}".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
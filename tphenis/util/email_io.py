@@ -6,15 +6,21 @@
 # ---------------------------------------------------------------------------------------------------------------------
 from datetime import datetime
 import email
+from email.message import EmailMessage
+from email.utils import parseaddr
 import hashlib
 import logging
 import os
+import secrets
 import smtplib
 import ssl
+import time
 
 from imapclient import IMAPClient
 
 from . import email_creds
+from . import fcast_cache
+from . import wxenums
 
 LOGGER = logging.getLogger('tphenis')
 
@@ -24,6 +30,19 @@ LOGGER = logging.getLogger('tphenis')
 
 SMTP_PORT = 465
 
+# Shared by email_watcher.py (writes subscriptions) and cache_forecast.py (delivers), so they live next to the cache
+# rather than in whatever directory each process happens to start in
+SUBSCRIPTION_FILE = os.path.join(fcast_cache.get_cache_base_dir(), "subscriptions.txt")
+PENDING_SUBSCRIPTION_FILE = os.path.join(fcast_cache.get_cache_base_dir(), "pending_subscriptions.txt")
+DELIVERY_LOG_FILE = os.path.join(fcast_cache.get_cache_base_dir(), "delivery_log.txt")
+
+SUBSCRIBE_CMD = "subscribe"
+UNSUBSCRIBE_CMD = "unsubscribe"
+CONFIRM_CMD = "confirm"
+
+FANOUT_BATCH_SIZE = 50  # recipients per SMTP transaction
+FANOUT_BATCH_INTERVAL = 2  # in seconds, pause between batches to stay under the provider's send rate
+
 # ---------------------------------------------------------------------------------------------------------------------
 # CLASSES
 # ---------------------------------------------------------------------------------------------------------------------
@@ -83,6 +102,138 @@ class EmailRegistry:
 
         self._hashes.add(hash(fre))
 
+
+# Subscriptions only take effect once confirmed: a subscribe request is held in the pending file with a random token,
+# and the address has to reply with that token.  Otherwise anyone could sign a third party up by forging From.
+class SubscriptionRegistry:
+    def __init__(self, subscription_file=SUBSCRIPTION_FILE, pending_file=PENDING_SUBSCRIPTION_FILE):
+        self._subscribers = dict()
+        self._pending = dict()
+        self.subscription_file = subscription_file
+        self.pending_file = pending_file
+
+    def load(self):
+        if os.path.exists(self.subscription_file):
+            with open(self.subscription_file, "r") as f:
+                for line in f.readlines():
+                    cols = line.split()
+                    if len(cols) != 3:
+                        LOGGER.warning("Skipping malformed subscription line: {}".format(line.strip()))
+                        continue
+                    try:
+                        key = (wxenums.ForecastSource[cols[1]], wxenums.Location[cols[2]])
+                    except KeyError:
+                        LOGGER.warning("Skipping subscription with unknown source or location: {}".format(
+                            line.strip()))
+                        continue
+                    self._subscribers.setdefault(key, set()).add(cols[0].lower())
+
+        if os.path.exists(self.pending_file):
+            with open(self.pending_file, "r") as f:
+                for line in f.readlines():
+                    cols = line.split()
+                    if len(cols) != 4:
+                        LOGGER.warning("Skipping malformed pending subscription line: {}".format(line.strip()))
+                        continue
+                    try:
+                        self._pending[cols[0]] = (cols[1].lower(), wxenums.ForecastSource[cols[2]],
+                                                  wxenums.Location[cols[3]])
+                    except KeyError:
+                        LOGGER.warning("Skipping pending subscription with unknown source or location: {}".format(
+                            line.strip()))
+
+    def save(self):
+        with open(self.subscription_file, "w") as f:
+            for (source, location), email_addresses in self._subscribers.items():
+                for email_address in sorted(email_addresses):
+                    f.write("{}\t{}\t{}\n".format(email_address, source.name, location.name))
+
+    def check(self, email_address, source, location):
+        return email_address in self._subscribers.get((source, location), set())
+
+    def subscribe(self, email_address, source, location):
+        if self.check(email_address, source, location):
+            return False
+
+        with open(self.subscription_file, "a") as f:
+            f.write("{}\t{}\t{}\n".format(email_address, source.name, location.name))
+
+        self._subscribers.setdefault((source, location), set()).add(email_address)
+        return True
+
+    def unsubscribe(self, email_address, source, location):
+        if not self.check(email_address, source, location):
+            return False
+
+        self._subscribers[(source, location)].discard(email_address)
+        self.save()
+        return True
+
+    def get_subscribers(self, source, location):
+        return sorted(self._subscribers.get((source, location), set()))
+
+    def save_pending(self):
+        with open(self.pending_file, "w") as f:
+            for token, (email_address, source, location) in self._pending.items():
+                f.write("{}\t{}\t{}\t{}\n".format(token, email_address, source.name, location.name))
+
+    def request_subscription(self, email_address, source, location):
+        # Asking again re-sends the same token rather than piling up pending entries
+        for token, pending in self._pending.items():
+            if pending == (email_address, source, location):
+                return token
+
+        token = secrets.token_hex(8)
+        with open(self.pending_file, "a") as f:
+            f.write("{}\t{}\t{}\t{}\n".format(token, email_address, source.name, location.name))
+
+        self._pending[token] = (email_address, source, location)
+        return token
+
+    def confirm_subscription(self, email_address, token):
+        # Returns the confirmed (source, location), or None if the token isn't pending for this address
+        pending = self._pending.get(token)
+        if pending is None or pending[0] != email_address:
+            return None
+
+        del self._pending[token]
+        self.save_pending()
+        self.subscribe(email_address, pending[1], pending[2])
+        return pending[1], pending[2]
+
+
+# Append-only record of which forecast revisions were pushed to which subscribers.  Re-running a fan-out for the same
+# revision (cache_forecast.py --retry-fanout) only sends to the subscribers that were not reached the first time.
+class DeliveryLog:
+    STATUS_OK = "OK"
+    STATUS_FAILED = "FAILED"
+
+    def __init__(self, log_file=DELIVERY_LOG_FILE):
+        self._delivered = set()
+        self.log_file = log_file
+
+    def load(self):
+        if not os.path.exists(self.log_file):
+            return
+
+        with open(self.log_file, "r") as f:
+            for line in f.readlines():
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) == 4 and cols[3] == DeliveryLog.STATUS_OK:
+                    self._delivered.add((cols[0], cols[1]))
+
+    def check(self, fcast_hash, email_address):
+        return (fcast_hash, email_address) in self._delivered
+
+    def add_entries(self, fcast_hash, email_addresses, status):
+        timestamp = datetime.now().strftime("%Y%m%d %H:%M:%S")
+        with open(self.log_file, "a") as f:
+            for email_address in email_addresses:
+                f.write("{}\t{}\t{}\t{}\n".format(fcast_hash, email_address, timestamp, status))
+
+        if status == DeliveryLog.STATUS_OK:
+            self._delivered.update((fcast_hash, email_address) for email_address in email_addresses)
+
 # ---------------------------------------------------------------------------------------------------------------------
 # METHODS
 # ---------------------------------------------------------------------------------------------------------------------
@@ -122,6 +273,7 @@ def get_smtp_client(host=email_creds.SMTP_HOST, username=email_creds.USERNAME, p
     smtp_client.login(username, password)
     return smtp_client
 
+
 def send_response(client, dest_email, message, from_email=email_creds.USERNAME):
     client.sendmail(from_email, dest_email, message)
 
@@ -157,8 +309,141 @@ def process_inbox_messages(messages, imap_client, fr_registry):
     return fre_list
 
 
-def process_forecast_requests(fre_list, smtp_client, imap_client, fr_registry):
+def parse_subscription_command(body):
+    # Expected form, on the first non-empty line: "subscribe <SOURCE> <LOCATION>", "unsubscribe <SOURCE> <LOCATION>"
+    # or "confirm <TOKEN>"
+    if body is None:
+        return None
+
+    for line in body.splitlines():
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        if len(tokens) == 2 and tokens[0].lower() == CONFIRM_CMD:
+            return CONFIRM_CMD, tokens[1]
+        if len(tokens) != 3 or tokens[0].lower() not in (SUBSCRIBE_CMD, UNSUBSCRIBE_CMD):
+            return None
+        try:
+            return tokens[0].lower(), wxenums.ForecastSource[tokens[1].upper()], wxenums.Location[tokens[2].upper()]
+        except KeyError:
+            LOGGER.warning("Unknown source or location in subscription command: {}".format(line.strip()))
+            return None
+
+    return None
+
+
+def process_subscription_command(fre, command, sub_registry):
+    # Addresses are compared case-insensitively, so 'Bob <U0@X>' and 'u0@x' are the same subscriber
+    email_address = parseaddr(fre.email_address)[1].lower()
+
+    if command[0] == CONFIRM_CMD:
+        confirmed = sub_registry.confirm_subscription(email_address, command[1])
+        if confirmed is None:
+            return "That confirmation code isn't valid for this address."
+        LOGGER.info("Subscribed {} to {} {}".format(email_address, confirmed[0].name, confirmed[1].name))
+        return "Subscribed to {} {}.".format(confirmed[0].name, confirmed[1].name)
+
+    cmd, source, location = command
+
+    if cmd == SUBSCRIBE_CMD:
+        if sub_registry.check(email_address, source, location):
+            return "Already subscribed to {} {}.".format(source.name, location.name)
+        token = sub_registry.request_subscription(email_address, source, location)
+        LOGGER.info("Requested confirmation from {} for {} {}".format(email_address, source.name, location.name))
+        return "To confirm your subscription to {} {}, reply with:\n\n{} {}".format(
+            source.name, location.name, CONFIRM_CMD, token)
+
+    if sub_registry.unsubscribe(email_address, source, location):
+        LOGGER.info("Unsubscribed {} from {} {}".format(email_address, source.name, location.name))
+        return "Unsubscribed from {} {}.".format(source.name, location.name)
+    return "Not subscribed to {} {}.".format(source.name, location.name)
+
+
+def process_forecast_requests(fre_list, smtp_client, imap_client, fr_registry, sub_registry=None):
     for fre in fre_list:
-        send_response(smtp_client, fre.email_address, "Bunk is cool.")
+        command = parse_subscription_command(fre.body_raw)
+        if command is not None and sub_registry is not None:
+            response = process_subscription_command(fre, command, sub_registry)
+        else:
+            response = "Bunk is cool."
+
+        send_response(smtp_client, fre.email_address, response)
         fr_registry.add_entry(fre)
-        archive_email(imap_client, fre.uid)
\ No newline at end of file
+        archive_email(imap_client, fre.uid)
+
+
+def render_forecast_message(source, location, body, subtype="plain", from_email=email_creds.USERNAME):
+    # Rendered once per revision; recipients are supplied on the SMTP envelope so the same bytes go to every batch.
+    msg = EmailMessage()
+    msg["From"] = from_email
+    msg["To"] = from_email
+    msg["Subject"] = "{} {} forecast update".format(source.name, location.name)
+    msg.set_content(body, subtype=subtype)
+    return msg.as_string()
+
+
+def fanout_forecast(source, location, body, fcast_hash, sub_registry, delivery_log, smtp_client=None, subtype="plain",
+                    batch_size=FANOUT_BATCH_SIZE, batch_interval=FANOUT_BATCH_INTERVAL,
+                    from_email=email_creds.USERNAME):
+    pending = [email_address for email_address in sub_registry.get_subscribers(source, location)
+               if not delivery_log.check(fcast_hash, email_address)]
+    if len(pending) == 0:
+        LOGGER.debug("No pending subscribers for {} {}".format(source.name, location.name))
+        return 0
+
+    LOGGER.info("Pushing forecast {} to {} subscribers".format(fcast_hash, len(pending)))
+    message = render_forecast_message(source, location, body, subtype=subtype, from_email=from_email)
+
+    own_client = smtp_client is None
+    if own_client:
+        smtp_client = get_smtp_client()
+
+    num_sent = 0
+    reconnected = False
+    i = 0
+    try:
+        while i < len(pending):
+            batch = pending[i:i + batch_size]
+            try:
+                refused = smtp_client.sendmail(from_email, batch, message)
+            except smtplib.SMTPServerDisconnected as e:
+                # Reconnect once; if the server keeps dropping us, give up on the rest rather than failing every batch
+                if reconnected:
+                    LOGGER.error("SMTP connection lost again, abandoning {} recipients: {}".format(len(pending) - i, e))
+                    delivery_log.add_entries(fcast_hash, pending[i:], DeliveryLog.STATUS_FAILED)
+                    break
+
+                LOGGER.warning("SMTP connection lost, reconnecting: {}".format(e))
+                reconnected = True
+                smtp_client.close()
+                try:
+                    smtp_client = get_smtp_client()
+                except (smtplib.SMTPException, OSError) as e:
+                    LOGGER.error("Could not reconnect, abandoning {} recipients: {}".format(len(pending) - i, e))
+                    delivery_log.add_entries(fcast_hash, pending[i:], DeliveryLog.STATUS_FAILED)
+                    smtp_client = None
+                    break
+                own_client = True
+                continue
+            except smtplib.SMTPException as e:
+                LOGGER.error("Batch delivery failed for {} recipients: {}".format(len(batch), e))
+                delivery_log.add_entries(fcast_hash, batch, DeliveryLog.STATUS_FAILED)
+            else:
+                delivered = [email_address for email_address in batch if email_address not in refused]
+                delivery_log.add_entries(fcast_hash, delivered, DeliveryLog.STATUS_OK)
+                if len(refused) > 0:
+                    LOGGER.warning("Recipients refused: {}".format(", ".join(refused)))
+                    delivery_log.add_entries(fcast_hash, list(refused), DeliveryLog.STATUS_FAILED)
+                num_sent += len(delivered)
+
+            i += batch_size
+            if i < len(pending):
+                time.sleep(batch_interval)
+    finally:
+        if own_client and smtp_client is not None:
+            try:
+                smtp_client.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp_client.close()
+
+    return num_sent
@@ -22,6 +22,12 @@ CACHE_DIR_NAME = "data"
 STANDARD_TIMEZONE = "US/Pacific"
 LOGGER = logging.getLogger('tphenis')
 
+# Called as callback(source, location, fcast_str, fcast_hash) whenever a new forecast revision is written to the cache
+NEW_FORECAST_CALLBACKS = []
+# Called as callback(source, location) whenever the cache changes, including the midnight carry-over symlink, which
+# isn't a new revision and so doesn't fire NEW_FORECAST_CALLBACKS
+CACHE_UPDATE_CALLBACKS = []
+
 # ---------------------------------------------------------------------------------------------------------------------
 # METHODS
 # ---------------------------------------------------------------------------------------------------------------------
@@ -77,6 +83,76 @@ def look_for_symlinks(cache_paths):
     return count
 
 
+def parse_revision(file_path):
+    # '.../20211103.2.txt' -> ('20211103', 2), or None if the file name isn't a cached forecast
+    parts = os.path.basename(file_path).split(".")
+    if len(parts) != 3 or parts[2] != "txt" or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+def get_revision_paths(source, location):
+    glob_str = os.path.join(get_cache_base_dir(), str(source.name).lower(), str(location.name).lower(), "*", "*.txt")
+    return glob.glob(glob_str)
+
+
+def get_cached_revisions(source, location):
+    # Returns (revision, mtime, path) for every distinct forecast in the cache, in issue order.  mtime rather than
+    # ctime, since the chmod after writing (or any later chmod/chown of the cache) resets ctime.  Symlinks carry a
+    # previous day's forecast forward and are skipped so each revision appears once; see get_cached_aliases().
+    revisions = []
+    for cur_file_path in get_revision_paths(source, location):
+        if os.path.islink(cur_file_path):
+            continue
+        key = parse_revision(cur_file_path)
+        if key is None:
+            continue
+        revisions.append((key, "{}.{}".format(*key), os.path.getmtime(cur_file_path), cur_file_path))
+
+    revisions.sort()
+    return [(revision, mtime, path) for key, revision, mtime, path in revisions]
+
+
+def get_cached_aliases(source, location):
+    # Maps each symlinked revision (e.g. '20211104.0') to the revision it points at (e.g. '20211103.2')
+    aliases = dict()
+    for cur_file_path in get_revision_paths(source, location):
+        if not os.path.islink(cur_file_path):
+            continue
+        key = parse_revision(cur_file_path)
+        target_key = parse_revision(os.path.realpath(cur_file_path))
+        if key is None or target_key is None:
+            continue
+        aliases["{}.{}".format(*key)] = "{}.{}".format(*target_key)
+
+    return aliases
+
+
+def register_new_forecast_callback(callback):
+    NEW_FORECAST_CALLBACKS.append(callback)
+
+
+def notify_new_forecast(source, location, fcast_str, fcast_hash):
+    for callback in NEW_FORECAST_CALLBACKS:
+        # A failing subscriber must not take down the cache write that already succeeded
+        try:
+            callback(source, location, fcast_str, fcast_hash)
+        except Exception:
+            LOGGER.exception("New forecast callback failed: {}".format(callback))
+
+
+def register_cache_update_callback(callback):
+    CACHE_UPDATE_CALLBACKS.append(callback)
+
+
+def notify_cache_update(source, location):
+    for callback in CACHE_UPDATE_CALLBACKS:
+        try:
+            callback(source, location)
+        except Exception:
+            LOGGER.exception("Cache update callback failed: {}".format(callback))
+
+
 def get_raw_forecast(source, location, use_cache=True, cache_timeout=300, save_forecast=True):
     time_now = datetime.now()
     yyyymmdd_today = get_YYYYMMDD(tgt_time=time_now)
@@ -133,6 +209,7 @@ def get_raw_forecast(source, location, use_cache=True, cache_timeout=300, save_f
                 LOGGER.info("Making symlink: {}".format(c_fpath))
                 os.makedirs(os.path.dirname(c_fpath), exist_ok=True)
                 os.symlink(os.path.relpath(cache_match, start=cache_dir), c_fpath)
+                notify_cache_update(source, location)
 
             return new_fcast_str
 
@@ -160,4 +237,7 @@ def get_raw_forecast(source, location, use_cache=True, cache_timeout=300, save_f
             f.write(new_fcast_str)
         os.chmod(c_fpath, 0o400)
 
+        notify_cache_update(source, location)
+        notify_new_forecast(source, location, new_fcast_str, new_fcst_hash)
+
     return new_fcast_str
@@ -0,0 +1,107 @@
+# Copyright 2021 Patrick Mauro and Harrison Hamlin
+# Contents are proprietary and confidential.
+
+# Wire protocol shared by fcast_server.py and fcast_query.py.  This module must stay standard-library only: the query
+# client imports it and is expected to start in a few milliseconds.
+#
+# Every frame is a 5-byte header (1-byte code, 4-byte big-endian payload length) followed by the payload.  In a
+# request the code is the operation and the payload is a tab-separated argument list; in a response the code is the
+# status and the payload is the UTF-8 forecast text (or an error message).
+
+# ---------------------------------------------------------------------------------------------------------------------
+# IMPORTS
+# ---------------------------------------------------------------------------------------------------------------------
+import os
+import socket
+import struct
+
+# ---------------------------------------------------------------------------------------------------------------------
+# GLOBALS
+# ---------------------------------------------------------------------------------------------------------------------
+
+SOCKET_ENV_VAR = "TPHENIS_SOCKET"
+SOCKET_FILE_NAME = "fcast.sock"
+
+HEADER = struct.Struct("!BI")
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Request operations
+OP_PING = 0
+OP_LATEST = 1  # args: source, location, field
+OP_GET = 2  # args: source, location, field, revision ('YYYYMMDD.N')
+OP_AS_OF = 3  # args: source, location, field, timestamp ('YYYYMMDD HH:MM:SS')
+OP_RELOAD = 4  # args: source, location
+
+# Response statuses
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_BAD_REQUEST = 2
+STATUS_ERROR = 3
+
+FIELD_RAW = "raw"
+FIELD_PARSED = "parsed"
+
+AS_OF_FORMAT = "%Y%m%d %H:%M:%S"  # read in fcast_cache.STANDARD_TIMEZONE, like the cache dates
+
+# ---------------------------------------------------------------------------------------------------------------------
+# METHODS
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def get_socket_path():
+    # Lives next to the forecast cache (see fcast_cache.get_cache_base_dir()) unless overridden from the environment
+    if SOCKET_ENV_VAR in os.environ:
+        return os.environ[SOCKET_ENV_VAR]
+    return os.path.abspath(os.path.join(__file__, "../../../data/{}".format(SOCKET_FILE_NAME)))
+
+
+def recv_exact(sock, num_bytes):
+    buf = bytearray()
+    while len(buf) < num_bytes:
+        chunk = sock.recv(num_bytes - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_frame(sock, code, payload=b""):
+    sock.sendall(HEADER.pack(code, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+
+    code, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise ValueError("Frame payload too large: {}".format(length))
+
+    payload = recv_exact(sock, length) if length > 0 else b""
+    if payload is None:
+        return None
+    return code, payload
+
+
+def encode_args(*args):
+    return "\t".join(args).encode()
+
+
+def decode_args(payload):
+    return payload.decode().split("\t") if payload else []
+
+
+def query(op, *args, socket_path=None, timeout=5.0):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path if socket_path is not None else get_socket_path())
+        send_frame(sock, op, encode_args(*args))
+        response = recv_frame(sock)
+    finally:
+        sock.close()
+
+    if response is None:
+        raise ConnectionError("Server closed the connection without responding")
+    return response
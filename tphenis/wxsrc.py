@@ -115,7 +115,6 @@ class MountRainierRecForecast(ForecastParser):
         match = re.search("&amp;&amp;(.*?)&amp;&amp;", fcst_body_stripped)
         if match and len(match.groups()) == 1:
             raw_ntef_string = match.group(1)
-            print(raw_ntef_string)
             #pf.synopsis = MountRainierRecForecast.clean_string(raw_syn_string)
         else:
             logging.warning("Could not parse near-term daily forecasts.")
@@ -124,6 +123,40 @@ class MountRainierRecForecast(ForecastParser):
         return pf
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# GLOBALS
+# ---------------------------------------------------------------------------------------------------------------------
+
+PARSERS = {
+    wxenums.ForecastSource.MORA_REC_FCST: MountRainierRecForecast
+}
+
+# ---------------------------------------------------------------------------------------------------------------------
+# METHODS
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def get_forecast_text(raw_text):
+    # The forecast products we scrape carry their text in a single <pre> block; returns it as plain text, or None if
+    # the page doesn't have one
+    pre = BeautifulSoup(raw_text, 'html.parser').pre
+    if pre is None:
+        return None
+    return pre.get_text().strip("\n")
+
+
+def render_forecast(source, raw_text):
+    # Returns the parsed forecast as text, or None if the source has no parser or the page couldn't be parsed
+    if source not in PARSERS:
+        return None
+
+    try:
+        return str(PARSERS[source]().parse_forecast(raw_text))
+    except Exception:
+        logging.exception("Could not parse forecast for {}".format(source.name))
+        return None
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # TEST CODE
 # ---------------------------------------------------------------------------------------------------------------------